@@ -2,17 +2,94 @@
 import argparse
 import configparser
 import difflib
+import errno
+import functools
 import hashlib
-import io
+import itertools
 import logging
+import mmap
 import os
+import pickle
+import shlex
 import shutil
+import stat
+import struct
 import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import patiencediff
+except ImportError:
+    patiencediff = None
+
 log = logging.getLogger(__name__)
 
+_HAVE_DIFF = shutil.which('diff') is not None
+
+# share one ssh connection between all ssh/scp calls to a remote pit
+SSH_OPTS = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=~/.ssh/cm-%r@%h:%p', '-o', 'ControlPersist=60']
+
+# most buffers a single writev takes
+try:
+    IOV_MAX = max(os.sysconf('SC_IOV_MAX'), 16)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# below this many files hashing serially beats the pool startup cost
+PARALLEL_THRESHOLD = 4
+
+# files handed to each pool worker at a time
+HASH_BATCH = 16
+
+# above this many files each batch is read ahead by the kernel before hashing
+BULK_THRESHOLD = 32
+
+# content hashes a pit can be configured with, [core] hash in the config
+HASH_ALGOS = ('sha256', 'blake3')
+
+# files at least this big are hashed straight out of a memory map
+MMAP_THRESHOLD = 1 << 20
+
+def new_hash():
+    ''' sha256 hasher, preferring the OpenSSL EVP path which can use SHA-NI '''
+    return hashlib.new('sha256', usedforsecurity=False)
+
+# binary index: the magic, then per entry mode, raw hash, path length, utf-8 path
+INDEX_MAGIC = b'PITIDX\x00\x01'
+INDEX_RECORD = struct.Struct('<I32sH')
+
+def pack_entry(mode, fhash, path):
+    path = path.encode()
+    return INDEX_RECORD.pack(int(mode), bytes.fromhex(fhash), len(path)) + path
+
+def unpack_index(data):
+    ''' (mode, hash, relpath) tuples from a binary or legacy text index, and
+    how many bytes of it are whole records, short of len(data) if the last
+    append was cut off '''
+    if not data.startswith(INDEX_MAGIC):
+        return [tuple(l.split(maxsplit=2)) for l in data.decode().splitlines() if l.strip()], len(data)
+    entries = []
+    offset = len(INDEX_MAGIC)
+    while offset + INDEX_RECORD.size <= len(data):
+        mode, fhash, length = INDEX_RECORD.unpack_from(data, offset)
+        if offset + INDEX_RECORD.size + length > len(data):
+            break
+        offset += INDEX_RECORD.size
+        entries.append((str(mode), fhash.hex(), data[offset:offset + length].decode()))
+        offset += length
+    return entries, offset
+
+# _hashlib is the OpenSSL wrapper, anything else is the builtin C fallback
+HASH_BACKEND = 'openssl' if type(new_hash()).__module__ == '_hashlib' else 'builtin'
+
 class Pit():
     def __init__(self, root):
         root = Path(root).resolve()
@@ -22,7 +99,90 @@ class Pit():
         self.config_fn = root / 'config'
 
         self._config = None
-        self._index = None
+        self._parsed_index = None
+        self._binary_index = True
+        self._torn_at = None
+        self._by_path = None
+        self._master = None
+        self._pending = []
+        self._uploads = []
+        self._index_fd = None
+        self._stat_cache = None
+        self._stat_cache_dirty = False
+        self._stat_current = {}
+
+    def __enter__(self):
+        # keep the local index open, appends are written on close
+        if ':' not in str(self.index_fn) and self._index_fd is None:
+            self.prepare_index() # before holding it open
+            self._index_fd = os.open(self.index_fn, os.O_WRONLY | os.O_APPEND | os.O_CLOEXEC)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # objects first so the index never points at missing data
+        self.flush_objects()
+        self.flush_index()
+        self.save_stat_cache()
+        if self._index_fd is not None:
+            os.close(self._index_fd)
+            self._index_fd = None
+
+    def connect(self, host):
+        ''' start the ssh master connection later calls multiplex over '''
+        if self._master is None:
+            self._master = subprocess.run(['ssh', *SSH_OPTS, host, 'true'], check=True)
+
+    @functools.cached_property
+    def hash_algo(self):
+        algo = self.config['core'].get('hash', 'sha256')
+        if algo not in HASH_ALGOS:
+            raise ValueError(f'Unknown hash {algo}, expected one of {HASH_ALGOS}')
+        if algo == 'blake3' and blake3 is None:
+            raise ImportError('blake3 hash requires the blake3 package')
+        return algo
+
+    @property
+    def stat_cache_fn(self):
+        # hashes from different algorithms must never mix
+        if self.hash_algo == 'sha256':
+            return self.root / 'stat_cache'
+        return self.root / f'stat_cache.{self.hash_algo}'
+
+    @property
+    def stat_cache(self):
+        ''' (st_dev, st_ino, st_mtime_ns, st_size) -> hash of files already hashed '''
+        if self._stat_cache is None:
+            try:
+                with open(self.stat_cache_fn, 'rb') as fd:
+                    self._stat_cache = pickle.load(fd)
+            except FileNotFoundError:
+                self._stat_cache = {}
+            except (EOFError, pickle.UnpicklingError):
+                # only a cache, rehashing rebuilds it
+                log.warning('Ignoring corrupt %s', self.stat_cache_fn)
+                self._stat_cache = {}
+        return self._stat_cache
+
+    def cache_hash(self, st, fhash):
+        self.stat_cache[stat_key(st)] = fhash
+        self._stat_current[st.st_dev, st.st_ino] = stat_key(st)
+        self._stat_cache_dirty = True
+
+    def save_stat_cache(self):
+        if not self._stat_cache_dirty:
+            return
+        # drop older versions of files that were rehashed this run
+        self._stat_cache = {key: fhash for key, fhash in self._stat_cache.items()
+                            if self._stat_current.get(key[:2], key) == key}
+        tmp_fn = self.stat_cache_fn.with_name(self.stat_cache_fn.name + '.tmp')
+        with open(tmp_fn, 'wb') as fd:
+            pickle.dump(self._stat_cache, fd)
+        os.replace(tmp_fn, self.stat_cache_fn)
+        self._stat_cache_dirty = False
+        self._stat_current = {}
 
     @property
     def config(self):
@@ -30,50 +190,159 @@ class Pit():
             self._config =  parse_config(self.config_fn)
         return self._config
 
-    @property
+    def reload_config(self):
+        self._config = None
+        for attr in ('object_store', 'index_fn', 'hash_algo'):
+            self.__dict__.pop(attr, None)
+
+    @functools.cached_property
     def object_store(self):
         return Path(self.config['core']['url'])
 
-    @property
+    @functools.cached_property
     def index_fn(self):
         return self.object_store.parent / 'index'
 
     @property
     def index(self):
-        if self._index is None:
+        ''' index entries as "mode hash relpath" lines '''
+        return [' '.join(e) for e in self.parsed_index]
+
+    @property
+    def parsed_index(self):
+        ''' index as (mode, hash, relpath) tuples '''
+        if self._parsed_index is None:
+            index_fn = self.index_fn
             if ':' in str(self.index_fn): # is remote
-                subprocess.run(f'scp {self.index_fn} {self.root}/index', shell=True, check=True)
-            with open(self.index_fn, 'r') as fd:
-                self._index = fd.readlines()
-        return self._index
+                self.connect(str(self.index_fn).split(':')[0])
+                subprocess.run(['scp', *SSH_OPTS, str(self.index_fn), str(self.root / 'index')], check=True)
+                index_fn = self.root / 'index'
+            with open(index_fn, 'rb') as fd:
+                data = fd.read()
+            self._parsed_index, end = unpack_index(data)
+            self._binary_index = data.startswith(INDEX_MAGIC)
+            if end < len(data):
+                log.warning('Ignoring torn record in %s at offset %d', self.index_fn, end)
+                self._torn_at = end
+        return self._parsed_index
+
+    def migrate_index(self):
+        ''' rewrite a legacy text index in the binary format '''
+        log.info('Migrating %s to binary index', self.index_fn)
+        tmp_fn = self.index_fn.with_name('index.tmp')
+        with open(tmp_fn, 'wb') as fd:
+            fd.write(INDEX_MAGIC)
+            fd.writelines(pack_entry(*e) for e in self._parsed_index)
+        os.replace(tmp_fn, self.index_fn)
+        self._binary_index = True
+
+    def prepare_index(self):
+        ''' get the index ready for appends, called before anything is written '''
+        self.parsed_index # loads the index and with it its format
+        # only our own index, a local clone's is another pit's that older code may still read
+        if not self._binary_index and self.index_fn.parent == self.root:
+            self.migrate_index()
+        if self._torn_at is None:
+            return
+        if ':' in str(self.index_fn):
+            raise ValueError(f'{self.index_fn} has a torn record at offset {self._torn_at}, refusing to append')
+        # new records must start where the last whole one ended
+        log.warning('Truncating torn record in %s at offset %d', self.index_fn, self._torn_at)
+        os.truncate(self.index_fn, self._torn_at)
+        self._torn_at = None
+
+    @property
+    def by_path(self):
+        ''' relpath -> (mode, hash) '''
+        if self._by_path is None:
+            self._by_path = {path: (mode, fhash) for mode, fhash, path in self.parsed_index}
+        return self._by_path
 
     def add_to_index(self, entry):
+        mode, fhash, path = entry.split(maxsplit=2)
+        self.prepare_index()
+        # indexes we don't migrate keep their format
+        if self._binary_index:
+            record = pack_entry(mode, fhash, path)
+        else:
+            record = f'{entry}\n'.encode()
         if ':' in str(self.index_fn):
-            host, path = str(self.index_fn).split(':')
-            subprocess.run(f'ssh {host} "echo {entry} >> {path}"', shell=True, check=True)
+            # batched, sent by flush_index
+            self._pending.append(record)
+        elif self._index_fd is not None:
+            # batched, written by flush_index
+            self._pending.append(record)
+        else:
+            with open(self.index_fn, 'ab') as fd:
+                fd.write(record)
+        self._parsed_index.append((mode, fhash, path))
+        self._by_path = None
+
+    def save_object(self, fn, fhash):
+        new_path = self.object_store / Path(fhash[:2]) / Path(fhash[2:])
+        if ':' in str(self.object_store) and shutil.which('rsync') is not None:
+            # batched, sent by flush_objects
+            self._uploads.append((fn, fhash))
         else:
-            with open(self.index_fn, 'a') as fd:
-                fd.write(f'{entry}\n')
-        if self._index is not None:
-            self._index.append(entry)
+            move(fn, new_path)
+
+    def flush_objects(self):
+        ''' send all pending objects to the remote store in one rsync '''
+        if not self._uploads:
+            return
+        self.connect(str(self.object_store).split(':')[0])
+        with tempfile.TemporaryDirectory(dir=self.root) as staging:
+            # lay the objects out as they will be in the store
+            for fn, fhash in self._uploads:
+                staged = Path(staging) / fhash[:2] / fhash[2:]
+                staged.parent.mkdir(exist_ok=True)
+                staged.symlink_to(fn)
+            subprocess.run(['rsync', '-rL', '--ignore-existing', '-e', ' '.join(['ssh', *SSH_OPTS]),
+                            f'{staging}/', f'{self.object_store}/'], check=True)
+        self._uploads = []
+
+    def flush_index(self):
+        ''' append all pending entries, locally in one writev or remotely in
+        one ssh call '''
+        if not self._pending:
+            return
+        if self._index_fd is not None:
+            write_all(self._index_fd, self._pending)
+            self._pending = []
+            return
+        host, path = str(self.index_fn).split(':')
+        self.connect(host)
+        # only the remote side sees a shell, so quote for it alone
+        subprocess.run(['ssh', *SSH_OPTS, host, f'cat >> {shlex.quote(path)}'], check=True, input=b''.join(self._pending))
+        self._pending = []
 
     def exists(self):
         return self.config_fn.exists()
 
-    def verify_file(self, fn):
-        if self.root in fn.parents:
-            log.warning(f'Refusing to save file in pit')
+    def verify_file(self, fn, base=None, st=None):
+        ''' base is the resolved directory files must be under, default the
+        pit root's parent. fn should already have its directories resolved,
+        only prefixes are compared so no path walk happens per file. st is
+        fn's lstat result if the caller already has it '''
+        if base is None:
+            base = self.root.parent
+        fn_abs = os.path.abspath(fn)
+        if fn_abs.startswith(os.path.join(self.root, '')):
+            log.warning('Refusing to save file in pit')
             return False
-        if fn.is_symlink():
-            log.warning(f'Refusing to backup symlink {fn}')
+        if st is None:
+            st = fn.lstat()
+        if stat.S_ISLNK(st.st_mode):
+            log.warning('Refusing to backup symlink %s', fn)
             return False
-        if not self.root.parent in fn.resolve().parents:
-            log.warning(f'Refusing to add file outside of pit root subdirectory')
+        if not fn_abs.startswith(os.path.join(base, '')):
+            log.warning('Refusing to add file outside of pit root subdirectory')
             return False
         return True
 
 def main(args):
     config = parse_config()
+    log.debug('Using %s sha256 backend', HASH_BACKEND)
     match args.command:
         case 'init':
             init(Path.cwd())
@@ -101,7 +370,7 @@ def init(dirc):
         pass
 
     write_default_config(pit.config_fn)
-    Path(pit.root / 'index').touch()
+    Path(pit.root / 'index').write_bytes(INDEX_MAGIC)
     pit.object_store.mkdir()
 
 def write_default_config(file='.pit/config'):
@@ -109,7 +378,7 @@ def write_default_config(file='.pit/config'):
     path.parent.mkdir(parents=True, exist_ok=True)
     config = configparser.ConfigParser()
     print(path)
-    config['core'] = {'url': str(path.parent / 'objects')}
+    config['core'] = {'url': str(path.parent / 'objects'), 'hash': 'sha256'}
     with open(path, 'w') as configfile:
         config.write(configfile)
 
@@ -126,7 +395,18 @@ def clone(old_pit, new_pit):
         raise FileExistsError('.pit already exists')
     pit.root.mkdir(parents=True, exist_ok=True)
 
-    pit.config['core'] = {'url': Path(old_pit) / '.pit' / 'objects'}
+    # the clone has to hash the same way as the store it writes into
+    old_config_fn = Path(old_pit) / '.pit' / 'config'
+    if ':' in str(old_pit): # is remote
+        pit.connect(str(old_pit).split(':')[0])
+        fetched = pit.root / 'origin_config'
+        subprocess.run(['scp', *SSH_OPTS, str(old_config_fn), str(fetched)], check=True)
+        old_config = parse_config(fetched)
+        fetched.unlink()
+    else:
+        old_config = parse_config(old_config_fn)
+    pit.config['core'] = {'url': Path(old_pit) / '.pit' / 'objects',
+                          'hash': old_config.get('core', 'hash', fallback='sha256')}
 
     # will make the necessary connections in the @property
     if pit.index is None:
@@ -147,83 +427,160 @@ def add(pit, tosave):
         log.error("pit doesn't exist")
         return
 
-    log.info(f'Adding {tosave}...')
+    log.info('Adding %s...', tosave)
 
-    # Get list of all files to save
+    # Get list of all files to save, resolving only the top so every path
+    # below it is already canonical (scandir never follows dir symlinks)
     if tosave.is_dir():
-        files = list(get_all_files(tosave))
+        tosave = tosave.resolve()
+        files = [(Path(e.path), e.stat(follow_symlinks=False)) for e in get_all_files(tosave)]
     else:
-        files = [tosave]
-
-    # Save files
-    for fn in files:
-        # Be a little safe in what we save
-        if not pit.verify_file(fn):
-            continue
+        tosave = tosave.parent.resolve() / tosave.name
+        files = [(tosave, tosave.lstat())]
+
+    # Be a little safe in what we save
+    base = pit.root.parent.resolve()
+    files = [(fn, st) for fn, st in files if pit.verify_file(fn, base, st)]
+
+    # Only hash files that changed since they were last hashed
+    with pit:
+        cached = {stat_key(st) for _, st in files if stat_key(st) in pit.stat_cache}
+        # hard links share an inode, only hash one of them
+        misses = {}
+        for fn, st in files:
+            if stat_key(st) not in cached:
+                misses.setdefault((st.st_dev, st.st_ino), (fn, st))
+        hashed = hash_files(list(misses.values()), pit.hash_algo)
+        save_hashed(pit, with_cached(pit, files, cached, hashed))
+
+def write_all(fd, chunks):
+    ''' write chunks with as few writev calls as IOV_MAX allows '''
+    for i in range(0, len(chunks), IOV_MAX):
+        batch = chunks[i:i + IOV_MAX]
+        written = os.writev(fd, batch)
+        # writev may stop short, finish off with plain writes
+        if written < sum(map(len, batch)):
+            rest = b''.join(batch)[written:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+
+def stat_key(st):
+    return st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size
+
+def with_cached(pit, files, cached, hashed):
+    ''' merge cached hashes back in with the freshly hashed files, in order '''
+    seen_inode = {}
+    for fn, st in files:
+        inode = st.st_dev, st.st_ino
+        if stat_key(st) in cached:
+            yield fn, st.st_mode, pit.stat_cache[stat_key(st)]
+        elif inode in seen_inode:
+            yield fn, st.st_mode, seen_inode[inode]
+        else:
+            _, mode, fhash = next(hashed)
+            pit.cache_hash(st, fhash)
+            seen_inode[inode] = fhash
+            yield fn, mode, fhash
+
+def hash_files(files, algo='sha256'):
+    ''' hash files in parallel, yielding (fn, mode, hash) in order '''
+    if len(files) < PARALLEL_THRESHOLD:
+        yield from (_hash_one(file, algo) for file in files)
+        return
+    with ProcessPoolExecutor() as ex:
+        if len(files) > BULK_THRESHOLD:
+            batches = [files[i:i + HASH_BATCH] for i in range(0, len(files), HASH_BATCH)]
+            yield from itertools.chain.from_iterable(ex.map(functools.partial(_bulk_hash, algo=algo, threaded=False), batches))
+        else:
+            yield from ex.map(functools.partial(_hash_one, algo=algo, threaded=False), files, chunksize=HASH_BATCH)
+
+def _hash_one(file, algo='sha256', threaded=True):
+    fn, st = file
+    return fn, st.st_mode, hash_content(fn, algo, threaded, st.st_size)
+
+def _bulk_hash(files, algo='sha256', threaded=True):
+    ''' hash a batch of files, queueing all their reads up front so the
+    kernel fetches the next files while the current one is hashed '''
+    if hasattr(os, 'posix_fadvise'):
+        for fn, st in files:
+            # big files stream with their own readahead anyway
+            if st.st_size < MMAP_THRESHOLD:
+                prefetch(fn)
+    return [_hash_one(file, algo, threaded) for file in files]
+
+def prefetch(fn):
+    ''' start async readahead of a file '''
+    fd = os.open(fn, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
 
-        # Write the file in content addressable fashion
-        fn = fn.resolve()
+def save_hashed(pit, hashed):
+    hashes = {index_hash for _, index_hash, _ in pit.parsed_index}
+    names  = set(pit.by_path)
 
-        mode     = fn.stat().st_mode
-        fhash    = hash_content(fn)
+    # Write the files in content addressable fashion
+    for fn, mode, fhash in hashed:
         rel_fn   = fn.relative_to(pit.root.parent)
         entry    = f'{mode} {fhash} {rel_fn}'
-        print(f'Adding entry {entry}')
-
-        new_path = pit.object_store / Path(fhash[:2]) / Path(fhash[2:])
+        log.info('Adding entry %s', entry)
 
         to_add = True
-        for e in pit.index:
-            _, index_hash, index_fn = e.strip().split()
-            if fhash == index_hash:
-                log.error('%s data already in index', fn)
-                to_add = False
-            if str(rel_fn) == index_fn:
-                log.error('%s warning duplicate names in index!', fn)
-                to_add = False
+        if fhash in hashes:
+            log.error('%s data already in index', fn)
+            to_add = False
+        if str(rel_fn) in names:
+            log.error('%s warning duplicate names in index!', fn)
+            to_add = False
 
         if to_add:
-            move(fn, new_path)
+            pit.save_object(fn, fhash)
             pit.add_to_index(entry)
+            hashes.add(fhash)
+            names.add(str(rel_fn))
 
 def checkout(pit, filename):
     filename = Path(filename).resolve().relative_to(pit.root.parent)
     log.debug('Checking out %s', filename)
-    for index_line in pit.index:
-        st_mode, fhash, path = index_line.split(maxsplit=3)
-        path = Path(path.strip())
-        if path != filename:
-            continue
-        saved_path = pit.object_store / fhash[:2] / fhash[2:]
-        move(saved_path, pit.root.parent / filename)
-        break
+    if str(filename) not in pit.by_path:
+        log.error('%s not in index', filename)
+        return
+    st_mode, fhash = pit.by_path[str(filename)]
+    saved_path = pit.object_store / fhash[:2] / fhash[2:]
+    move(saved_path, pit.root.parent / filename)
 
 def get_all_files(dirname, ignore_hidden=True):
-    for dirpath, dirnames, filenames in os.walk(dirname):
-        if ignore_hidden:
-            for dirname in dirnames.copy():
-                if dirname.startswith('.'):
-                    log.warning(f'Skipping hidden dir {dirname}')
-                    del dirnames[dirnames.index(dirname)]
-        for fn in filenames:
-            yield Path(dirpath) / fn
-
-def diff(file1, file2, outfile=None, use_shell=False):
-    patch = io.BytesIO()
+    ''' yield an os.DirEntry for every file below dirname, its stat is cached '''
+    with os.scandir(dirname) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if ignore_hidden and entry.name.startswith('.'):
+                    log.warning('Skipping hidden dir %s', entry.name)
+                    continue
+                yield from get_all_files(entry.path, ignore_hidden)
+            elif entry.is_file():
+                yield entry
+
+def diff(file1, file2, outfile=None, use_shell=_HAVE_DIFF, text=True):
+    ''' unified diff of file1 and file2, as bytes unless text is set,
+    or written straight to outfile '''
     if use_shell and shutil.which('diff') is not None:
         ret = subprocess.run(['diff', '-u', '-t', file1, file2], capture_output=True)
-        patch.write(ret.stdout)
+        patch = ret.stdout
     else:
         with open(file1, 'rb') as fd1, open(file2, 'rb') as fd2:
             data1, data2 = fd1.readlines(), fd2.readlines()
-        d = difflib.diff_bytes(difflib.unified_diff, data1, data2, file1.encode(), file2.encode(), file_mtime(file1).encode(), file_mtime(file2).encode())
-        patch.writelines(d)
-    patch.seek(0)
-    wrapper = io.TextIOWrapper(patch)
+        if patiencediff is not None:
+            unified_diff = functools.partial(patiencediff.unified_diff, sequencematcher=patiencediff.PatienceSequenceMatcher)
+        else:
+            unified_diff = difflib.unified_diff
+        d = difflib.diff_bytes(unified_diff, data1, data2, file1.encode(), file2.encode(), file_mtime(file1).encode(), file_mtime(file2).encode())
+        patch = b''.join(d)
     if outfile is None:
-        return wrapper.read()
-    with open(outfile, 'w') as outfd:
-        outfd.write(wrapper.read())
+        return patch.decode('utf-8', 'replace') if text else patch
+    with open(outfile, 'wb') as outfd:
+        outfd.write(patch)
 
 def patch(file, patch):
     subprocess.run(['patch', file, patch])
@@ -233,24 +590,71 @@ def file_mtime(path):
     return t.astimezone().isoformat()
 
 def move(from_path, to_path):
-    log.info(f'Moving {from_path} -> {to_path}')
+    log.info('Moving %s -> %s', from_path, to_path)
     if ':' in str(from_path) or ':' in str(to_path):
         host, path = str(to_path).split(':')
-        subprocess.run(f'ssh {host} "mkdir -p $(dirname {path})"', shell=True, check=True)
-        subprocess.run(f'scp {from_path} {to_path}', shell=True, check=True)
+        subprocess.run(['ssh', *SSH_OPTS, host, f'mkdir -p {shlex.quote(os.path.dirname(path))}'], check=True)
+        subprocess.run(['scp', *SSH_OPTS, str(from_path), str(to_path)], check=True)
     else:
         to_path.parent.mkdir(parents=True, exist_ok=True)
-        os.link(from_path, to_path)
+        try:
+            os.link(from_path, to_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            copy_file(from_path, to_path)
         from_path.chmod(0o440)
         to_path.chmod(0o440)
 
-def hash_content(file):
-    log.info(f'Hashing {file}')
-    path = Path(file)
-    h = hashlib.sha256()
-    with open(file, 'rb') as fd:
-        h.update(fd.read(4096))
-    return h.hexdigest()
+def copy_file(from_path, to_path):
+    ''' copy across filesystems, in kernel (or as a reflink) where possible '''
+    if hasattr(os, 'copy_file_range'):
+        with open(from_path, 'rb') as src, open(to_path, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                # older kernels refuse cross filesystem copies
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+    shutil.copy2(from_path, to_path)
+
+def hash_content(file, algo='sha256', threaded=True, size=None):
+    ''' threaded lets blake3 use every core, off inside pool workers, size
+    saves a stat when the caller already knows it '''
+    log.info('Hashing %s', file)
+    if algo == 'blake3':
+        # reads straight from an mmap
+        h = blake3.blake3(max_threads=blake3.blake3.AUTO if threaded else 1)
+        h.update_mmap(file)
+        return h.hexdigest()
+    if size is None:
+        size = os.stat(file).st_size
+    if size >= MMAP_THRESHOLD:
+        h = new_hash()
+        with open(file, 'rb') as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(mm)
+            fadvise(fd, 'POSIX_FADV_DONTNEED')
+        return h.hexdigest()
+    with open(file, 'rb', buffering=0) as fd:
+        fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+        digest = hashlib.file_digest(fd, new_hash).hexdigest()
+        # the data won't be read again, keep it from evicting hotter pages
+        fadvise(fd, 'POSIX_FADV_DONTNEED')
+    return digest
+
+def fadvise(fd, advice):
+    ''' hint the kernel about the whole file, a no-op where unsupported '''
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd.fileno(), 0, 0, getattr(os, advice))
 
 def is_newer(file, dep):
     return os.stat(file).st_mtime > os.stat(dep).st_mtime
@@ -291,7 +695,7 @@ if __name__ == '__main__':
     #  diffcmd = commands.add_parser('diff')
     #  diffcmd.add_argument('path')
     #  diffcmd.add_argument('cmp')
-    #  diffcmd.add_argument('--use_shell', action='store_true')
+    #  diffcmd.add_argument('--use_shell', action=argparse.BooleanOptionalAction, default=_HAVE_DIFF)
 
     checkoutcmd = commands.add_parser('checkout')
     checkoutcmd.add_argument('filename')
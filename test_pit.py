@@ -1,9 +1,14 @@
 import pytest
+import errno
+import os
+import shutil
 import subprocess
 import string
 import random
 
-from pit import init, parse_config, clone, Pit, hash_content, add, checkout
+import pit as pit_module
+
+from pit import init, parse_config, clone, Pit, hash_content, add, checkout, diff, pack_entry, INDEX_MAGIC, MMAP_THRESHOLD, BULK_THRESHOLD
 
 def test_all():
     test_here()
@@ -45,6 +50,29 @@ def test_init(tmp_dir):
     assert 'url' in config['core']
     assert str(object_store) == config['core']['url']
 
+def test_parse_config_reread(tmp_path):
+    init(tmp_path)
+    config_fn = tmp_path / '.pit' / 'config'
+    config = parse_config(config_fn)
+    config['core']['url'] = 'changed'
+    assert parse_config(config_fn)['core']['url'] == str(tmp_path / '.pit' / 'objects')
+
+    with open(config_fn, 'w') as fd:
+        config.write(fd)
+    assert parse_config(config_fn)['core']['url'] == 'changed'
+
+def test_parse_config_raw(tmp_path):
+    config_fn = tmp_path / 'config'
+    config_fn.write_text('[DEFAULT]\nfoo = bar\n\n[core]\nurl = /data/100%%/objects\n')
+    config = parse_config(config_fn)
+    assert config['core']['url'] == '/data/100%/objects'
+    assert config['core']['foo'] == 'bar'
+
+    with open(config_fn, 'w') as fd:
+        config.write(fd)
+    assert 'foo' not in config_fn.read_text().split('[core]')[1]
+    assert parse_config(config_fn)['core']['url'] == '/data/100%/objects'
+
 def test_clone(tmp_dir):
     init_dir, clone_dir = tmp_dir
     init(init_dir)
@@ -53,6 +81,23 @@ def test_clone(tmp_dir):
 
     assert cloned_pit.object_store == init_dir / '.pit' / 'objects'
 
+def test_clone_remote_hash(tmp_dir, monkeypatch):
+    init_dir, clone_dir = tmp_dir
+    init(init_dir)
+    config_fn = init_dir / '.pit' / 'config'
+    config = parse_config(config_fn)
+    config['core']['hash'] = 'blake3'
+    with open(config_fn, 'w') as fd:
+        config.write(fd)
+
+    # scp from host:path copies from the local path
+    def run(cmd, **kwargs):
+        if cmd[0] == 'scp':
+            shutil.copy(cmd[-2].split(':', 1)[1], cmd[-1])
+    monkeypatch.setattr(subprocess, 'run', run)
+    clone(f'host:{init_dir}', clone_dir)
+    assert parse_config(clone_dir / '.pit' / 'config')['core']['hash'] == 'blake3'
+
 def test_add(tmp_dir):
     init_dir, _ = tmp_dir
     file = init_dir / 'file.txt'
@@ -63,6 +108,110 @@ def test_add(tmp_dir):
     add(pit, file)
     assert file_in_pit(pit, file.relative_to(pit.root.parent))
 
+def test_add_dir(tmp_dir):
+    init_dir, _ = tmp_dir
+    subdir = init_dir / 'sub'
+    subdir.mkdir()
+    files = [random_file(subdir, f'file{i}') for i in range(8)]
+    (subdir / 'nested').mkdir()
+    files.append(random_file(subdir / 'nested', 'file'))
+    (subdir / '.hidden').mkdir()
+    hidden = random_file(subdir / '.hidden', 'file')
+
+    init(init_dir)
+    pit = Pit(init_dir)
+    add(pit, subdir)
+    for file in files:
+        assert file_in_pit(pit, file)
+    assert not file_in_pit(pit, hidden)
+
+def test_add_bulk(tmp_path):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    subdir = tmp_path / 'sub'
+    subdir.mkdir()
+    files = [random_file(subdir, f'file{i}') for i in range(BULK_THRESHOLD + 1)]
+
+    add(pit, subdir)
+    for file in files:
+        assert file_in_pit(pit, file)
+
+def test_add_stat_cache(tmp_path, monkeypatch):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    file = random_file(tmp_path, 'file')
+    add(pit, file)
+
+    monkeypatch.setattr(pit_module, 'hash_content', lambda *args: pytest.fail('rehashed unchanged file'))
+    pit = Pit(tmp_path)
+    add(pit, file)
+    assert file_in_pit(pit, file)
+
+def test_stat_cache_corrupt(tmp_path):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    add(pit, random_file(tmp_path, 'file'))
+    cache_fn = pit.root / 'stat_cache'
+    cache_fn.write_bytes(cache_fn.read_bytes()[:-1])
+
+    pit = Pit(tmp_path)
+    file = random_file(tmp_path, 'file2')
+    add(pit, file)
+    assert file_in_pit(pit, file)
+    assert len(Pit(tmp_path).stat_cache) == 1
+
+def test_stat_cache_prune(tmp_path):
+    init(tmp_path)
+    file = random_file(tmp_path, 'file')
+    pit = Pit(tmp_path)
+    pit.cache_hash(file.stat(), 'aa' * 32)
+    pit.save_stat_cache()
+
+    os.utime(file, ns=(0, 0))
+    pit = Pit(tmp_path)
+    pit.cache_hash(file.stat(), 'bb' * 32)
+    pit.save_stat_cache()
+    assert list(Pit(tmp_path).stat_cache.values()) == ['bb' * 32]
+
+def test_add_hardlinks(tmp_path, monkeypatch):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    subdir = tmp_path / 'sub'
+    subdir.mkdir()
+    file = random_file(subdir, 'file')
+    os.link(file, subdir / 'link')
+
+    hashed = []
+    hash_content = pit_module.hash_content
+    monkeypatch.setattr(pit_module, 'hash_content', lambda *args: hashed.append(args) or hash_content(*args))
+    add(pit, subdir)
+    assert len(hashed) == 1
+    assert file_in_pit(pit, file) != file_in_pit(pit, subdir / 'link')
+
+def test_add_refused(tmp_path):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    outside = random_file(tmp_path.parent, f'{tmp_path.name}-outside')
+    link = tmp_path / 'link'
+    link.symlink_to(random_file(tmp_path, 'file'))
+
+    add(pit, outside)
+    add(pit, link)
+    add(pit, pit.root / 'config')
+    assert pit.index == []
+
+def test_add_duplicate_content(tmp_path):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    file = random_file(tmp_path, 'file')
+    copy = tmp_path / 'copy'
+    copy.write_text(file.read_text())
+
+    add(pit, file)
+    add(pit, copy)
+    assert file_in_pit(pit, file)
+    assert not file_in_pit(pit, copy)
+
 def test_clone_add(tmp_dir):
     init_dir, clone_dir = tmp_dir
     init(init_dir)
@@ -97,15 +246,164 @@ def test_checkout(tmp_path):
     assert file.exists()
     assert file_in_pit(pit, file)
 
+def test_index_append(tmp_path):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    with pit:
+        pit.add_to_index(f'1 {"aa" * 32} a')
+    pit.add_to_index(f'1 {"bb" * 32} b')
+    assert Pit(tmp_path).index == [f'1 {"aa" * 32} a', f'1 {"bb" * 32} b']
+
+def test_index_append_batched(tmp_path, monkeypatch):
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    writes = []
+    writev = os.writev
+    monkeypatch.setattr(os, 'writev', lambda fd, chunks: writes.append(len(chunks)) or writev(fd, chunks))
+    with pit:
+        for h in ['aa', 'bb', 'cc']:
+            pit.add_to_index(f'1 {h * 32} {h}')
+        assert writes == []
+    assert writes == [3]
+    assert [e[2] for e in Pit(tmp_path).parsed_index] == ['aa', 'bb', 'cc']
+
+def test_index_migrate(tmp_path):
+    init(tmp_path)
+    index_fn = tmp_path / '.pit' / 'index'
+    index_fn.write_text(f'1 {"aa" * 32} a\n')
+
+    pit = Pit(tmp_path)
+    pit.add_to_index(f'1 {"bb" * 32} b c')
+    assert index_fn.read_bytes().startswith(INDEX_MAGIC)
+    assert Pit(tmp_path).parsed_index == [('1', 'aa' * 32, 'a'), ('1', 'bb' * 32, 'b c')]
+
+def test_index_migrate_only_own(tmp_dir):
+    init_dir, clone_dir = tmp_dir
+    init(init_dir)
+    index_fn = init_dir / '.pit' / 'index'
+    index_fn.write_text(f'1 {"aa" * 32} a\n')
+    clone(init_dir, clone_dir)
+
+    assert Pit(clone_dir).parsed_index == [('1', 'aa' * 32, 'a')]
+    Pit(clone_dir).add_to_index(f'1 {"bb" * 32} b')
+    assert Pit(init_dir).parsed_index == [('1', 'aa' * 32, 'a'), ('1', 'bb' * 32, 'b')]
+    assert not index_fn.read_bytes().startswith(INDEX_MAGIC)
+
+    # reading doesn't migrate, writing does
+    assert 'a' in Pit(init_dir).by_path
+    assert not index_fn.read_bytes().startswith(INDEX_MAGIC)
+    with Pit(init_dir):
+        pass
+    assert index_fn.read_bytes().startswith(INDEX_MAGIC)
+
+def test_index_torn(tmp_path):
+    init(tmp_path)
+    index_fn = tmp_path / '.pit' / 'index'
+    pit = Pit(tmp_path)
+    pit.add_to_index(f'1 {"aa" * 32} a')
+    pit.add_to_index(f'1 {"bb" * 32} bbbb')
+    whole = index_fn.read_bytes()
+
+    # cut into the path, then into the record header
+    for cut in [2, 10]:
+        index_fn.write_bytes(whole[:-cut])
+        assert Pit(tmp_path).parsed_index == [('1', 'aa' * 32, 'a')]
+
+    pit = Pit(tmp_path)
+    pit.add_to_index(f'1 {"cc" * 32} c')
+    assert Pit(tmp_path).parsed_index == [('1', 'aa' * 32, 'a'), ('1', 'cc' * 32, 'c')]
+
+def test_remote_index_batched(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: calls.append((args, kwargs)))
+    pit = Pit(tmp_path)
+    pit._config = {'core': {'url': 'host:/remote/.pit/objects'}}
+    # stands in for the copy scp would fetch
+    pit.root.mkdir()
+    (pit.root / 'index').write_bytes(INDEX_MAGIC)
+
+    with pit:
+        pit.add_to_index(f'1 {"aa" * 32} a')
+        pit.add_to_index(f'1 {"bb" * 32} b')
+    appends = [kwargs['input'] for _, kwargs in calls if 'input' in kwargs]
+    assert appends == [pack_entry('1', 'aa' * 32, 'a') + pack_entry('1', 'bb' * 32, 'b')]
+    assert not any(kwargs.get('shell') for _, kwargs in calls)
+
+def test_remote_objects_batched(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: calls.append(args[0]))
+    monkeypatch.setattr(shutil, 'which', lambda cmd: f'/usr/bin/{cmd}')
+    pit = Pit(tmp_path)
+    pit.root.mkdir()
+    pit._config = {'core': {'url': 'host:/remote/.pit/objects'}}
+
+    with pit:
+        for name in ['file', 'file2']:
+            file = random_file(tmp_path, name)
+            pit.save_object(file, hash_content(file))
+    assert [c[0] for c in calls if isinstance(c, list)].count('rsync') == 1
+
+def test_add_cross_device(tmp_path, monkeypatch):
+    def link(*args):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+    monkeypatch.setattr(os, 'link', link)
+    init(tmp_path)
+    pit = Pit(tmp_path)
+
+    file = random_file(tmp_path, 'file')
+    add(pit, file)
+    assert file_in_pit(pit, file)
+    fhash = hash_content(file)
+    assert (pit.object_store / fhash[:2] / fhash[2:]).read_text() == file.read_text()
+
 def test_hash(tmp_path):
     file = random_file(tmp_path, 'file')
     digest = hash_content(file)
     shell_digest = subprocess.run(f'shasum -a 256 {file}', shell=True, capture_output=True)
     assert digest == shell_digest.stdout.split()[0].decode()
 
-def random_file(file_dir, name):
+def test_hash_large(tmp_path):
+    file = random_file(tmp_path, 'file', k=8192)
+    other = tmp_path / 'other'
+    other.write_text(file.read_text()[:-1] + '!')
+    assert hash_content(file) != hash_content(other)
+
+def test_hash_mmap(tmp_path):
+    file = random_file(tmp_path, 'file', k=MMAP_THRESHOLD + 1)
+    digest = hash_content(file)
+    shell_digest = subprocess.run(f'shasum -a 256 {file}', shell=True, capture_output=True)
+    assert digest == shell_digest.stdout.split()[0].decode()
+
+def test_diff(tmp_path):
+    file = tmp_path / 'file'
+    file2 = tmp_path / 'file2'
+    file.write_text('a\nb\n')
+    file2.write_text('a\nc\n')
+
+    patch = diff(str(file), str(file2))
+    assert '-b\n+c\n' in patch
+    assert '-b\n+c\n' in diff(str(file), str(file2), use_shell=False)
+    assert diff(str(file), str(file2), text=False) == patch.encode()
+
+    outfile = tmp_path / 'patch'
+    diff(str(file), str(file2), outfile=outfile)
+    assert outfile.read_text() == patch
+
+def test_add_blake3(tmp_path):
+    blake3 = pytest.importorskip('blake3')
+    init(tmp_path)
+    pit = Pit(tmp_path)
+    pit.config['core']['hash'] = 'blake3'
+
+    file = random_file(tmp_path, 'file')
+    digest = blake3.blake3(file.read_bytes()).hexdigest()
+    assert hash_content(file, 'blake3') == digest
+    add(pit, file)
+    assert (pit.object_store / digest[:2] / digest[2:]).exists()
+
+def random_file(file_dir, name, k=42):
     file = file_dir / name
-    file.write_text(''.join(random.choices(string.ascii_letters, k=42)))
+    file.write_text(''.join(random.choices(string.ascii_letters, k=k)))
     return file
 
 def file_in_pit(pit, file, just_index=False):